@@ -0,0 +1,525 @@
+"""Vectorized simulations for assessing models, shared by the notebooks in
+chapter 11.
+
+Instead of drawing one random sample per repetition in a loop, the
+functions draw all the samples with one call to the random number generator,
+one sample per row of an array, and compute the statistic of every sample
+with one reduction along the rows.
+
+The k-group permutation test works the same way: it shuffles many copies of
+the group labels at once and computes the group sums of every shuffle with
+one call to np.bincount.
+"""
+
+from math import lgamma
+from statistics import NormalDist
+
+import numpy as np
+
+# Largest number of bytes the simulated counts may use at once
+DEFAULT_MEMORY_BUDGET = 64 * 2**20
+
+# Chances in the upper tail at which an approximation is checked against a
+# calibration simulation (as well as at the observed statistic), since
+# larger P-values do not decide a test
+CALIBRATION_LEVELS = np.array([0.1, 0.05, 0.01])
+
+# Default fraction of the Monte Carlo repetitions simulated to calibrate an
+# approximation
+CALIBRATION_FRACTION = 0.2
+
+
+def sample_proportions(sample_size, probabilities, repetitions=None, seed=None):
+    """Returns the proportions in each category of a random sample drawn
+    with replacement from a distribution:
+    sample_size: number of draws in the sample
+    probabilities: array of the chances of the categories
+    repetitions: if given, the number of samples; the result then has one
+        row of proportions per sample
+    seed: seed for the random draws
+    """
+    rng = np.random.default_rng(seed)
+    counts = rng.multinomial(sample_size, np.asarray(probabilities), size=repetitions)
+    return counts / sample_size
+
+
+def total_variation_distance(distribution_1, distribution_2):
+    """Returns the total variation distance between two distributions; if
+    either is a 2-D array of distributions, one per row, the result has one
+    distance per row"""
+    differences = np.asarray(distribution_1) - np.asarray(distribution_2)
+    return np.abs(differences).sum(axis=-1) / 2
+
+
+def chi_square_statistics(proportions, probabilities, sample_size):
+    """Returns the chi-square statistic, the sum over the categories of
+    (observed count - expected count)**2 / expected count"""
+    return sample_size * ((proportions - probabilities) ** 2 / probabilities).sum(axis=-1)
+
+
+def g_statistics(proportions, probabilities, sample_size):
+    """Returns the G (likelihood ratio) statistic, twice the sum over the
+    categories of observed count * log(observed count / expected count)"""
+    ratios = np.where(proportions > 0, proportions / probabilities, 1)
+    return 2 * sample_size * (proportions * np.log(ratios)).sum(axis=-1)
+
+
+def max_deviations(proportions, probabilities, sample_size):
+    """Returns the largest absolute difference between an observed and an
+    expected proportion"""
+    return np.abs(proportions - probabilities).max(axis=-1)
+
+
+def ks_statistics(proportions, probabilities, sample_size):
+    """Returns the Kolmogorov-Smirnov statistic for ordered categories, the
+    largest absolute difference between the observed and the expected
+    cumulative proportions"""
+    differences = np.cumsum(proportions - probabilities, axis=-1)
+    return np.abs(differences).max(axis=-1)
+
+
+def tvd_statistics(proportions, probabilities, sample_size):
+    """Returns the total variation distance between the observed and the
+    expected proportions"""
+    return total_variation_distance(proportions, probabilities)
+
+
+# Statistics that compare observed proportions with the chances of the
+# categories; each takes arrays of proportions (one distribution per row),
+# the chances, and the sample size, and large values are evidence against
+# the chances
+GOODNESS_OF_FIT_STATISTICS = {
+    'tvd': tvd_statistics,
+    'chi-square': chi_square_statistics,
+    'g': g_statistics,
+    'max deviation': max_deviations,
+    'ks': ks_statistics,
+}
+
+
+def goodness_of_fit_test(observed, probabilities, sample_size, repetitions,
+                         statistics=None, seed=None):
+    """Returns a dictionary of the P-values of tests of whether a sample
+    looks like a random sample from a distribution, one for each statistic,
+    and a dictionary of the statistics simulated under the null hypothesis:
+    observed: array of the proportions in each category in the sample
+    probabilities: array of the chances of the categories under the null
+        hypothesis
+    sample_size: number of draws in the sample
+    repetitions: number of samples to simulate
+    statistics: list of names of statistics in GOODNESS_OF_FIT_STATISTICS,
+        or all of them by default
+    seed: seed for the random draws
+
+    Every statistic is computed on the same simulated samples, so trying
+    another statistic needs no more sampling.
+    """
+    if statistics is None:
+        statistics = list(GOODNESS_OF_FIT_STATISTICS)
+    for name in statistics:
+        if name not in GOODNESS_OF_FIT_STATISTICS:
+            raise ValueError(f"unknown statistic: {name!r}")
+    observed = np.asarray(observed, dtype=float)
+    probabilities = np.asarray(probabilities, dtype=float)
+    simulated_proportions = sample_proportions(sample_size, probabilities, repetitions, seed)
+
+    p_values = {}
+    simulated = {}
+    for name in statistics:
+        statistic = GOODNESS_OF_FIT_STATISTICS[name]
+        observed_statistic = statistic(observed, probabilities, sample_size)
+        simulated[name] = statistic(simulated_proportions, probabilities, sample_size)
+        slack = 1e-9 * max(abs(observed_statistic), 1)
+        p_values[name] = np.count_nonzero(simulated[name] >= observed_statistic - slack) / repetitions
+    return p_values, simulated
+
+
+def panel_test(sizes, observed, probabilities, repetitions, seed=None,
+               memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Returns the P-value of a test of whether each of several samples
+    (panels) of different sizes looks like a random sample from a
+    distribution, using the total variation distance as the statistic:
+    sizes: array of the sample size of each panel
+    observed: array with one row per panel of its proportions in each
+        category
+    probabilities: array of the chances of the categories under the null
+        hypothesis, or one row of chances per panel
+    repetitions: number of samples simulated for each panel
+    seed: seed for the random draws
+    memory_budget: number of bytes the simulated counts may use at once
+
+    All the panels are simulated together: each draw is an array of counts
+    with one row per panel, and the multinomial generator takes each row's
+    sample size from sizes, so the cost does not depend on the sizes.
+    """
+    sizes = np.asarray(sizes)
+    observed = np.asarray(observed, dtype=float)
+    probabilities = np.broadcast_to(np.asarray(probabilities, dtype=float), observed.shape)
+    observed_distances = total_variation_distance(observed, probabilities)
+    slack = 1e-9
+    rng = np.random.default_rng(seed)
+
+    panels, categories = observed.shape
+    chunk_size = max(1, min(repetitions, memory_budget // (panels * categories * 8 * 2)))
+    exceedances = np.zeros(panels, dtype=np.int64)
+    for start in np.arange(0, repetitions, chunk_size):
+        count = min(chunk_size, repetitions - start)
+        counts = rng.multinomial(sizes, probabilities, size=(count, panels))
+        distances = total_variation_distance(counts / sizes[:, np.newaxis], probabilities)
+        exceedances += np.count_nonzero(distances >= observed_distances - slack, axis=0)
+    return exceedances / repetitions
+
+
+def power_surface(probabilities, alternatives, sample_sizes, repetitions, statistic='tvd',
+                  level=0.05, seed=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Returns an array of the chances that a test of a model rejects it at
+    a level, with one row per alternative distribution and one column per
+    sample size:
+    probabilities: array of the chances of the categories in the model
+    alternatives: array with one row per alternative distribution of the
+        chances of the categories
+    sample_sizes: array of the sample sizes
+    repetitions: number of samples simulated for each sample size under the
+        model (to find the cutoffs) and under each alternative
+    statistic: name of a statistic in GOODNESS_OF_FIT_STATISTICS
+    level: the model is rejected when the P-value is at most level
+    seed: seed for the random draws
+    memory_budget: number of bytes the simulated counts may use at once;
+        the simulated statistics of the model, 8 bytes per repetition and
+        sample size, are kept in addition, to find the cutoffs
+
+    The samples for all the alternatives and sample sizes are drawn
+    together, by broadcasting the sample sizes against the alternatives in
+    the multinomial generator.
+    """
+    if statistic not in GOODNESS_OF_FIT_STATISTICS:
+        raise ValueError(f"unknown statistic: {statistic!r}")
+    statistic = GOODNESS_OF_FIT_STATISTICS[statistic]
+    probabilities = np.asarray(probabilities, dtype=float)
+    alternatives = np.asarray(alternatives, dtype=float)
+    sample_sizes = np.asarray(sample_sizes)
+    rng = np.random.default_rng(seed)
+
+    # A sample's P-value is at most level when no more than allowed of the
+    # simulated statistics are at least as large as its statistic, that is,
+    # when its statistic is above the cutoff
+    allowed = int(np.floor(level * repetitions))
+    if allowed >= repetitions:
+        return np.ones((len(alternatives), len(sample_sizes)))
+    # The counts are drawn in chunks that fit in memory_budget; only the
+    # statistics (one per repetition and sample size) are kept for the cutoffs
+    null_statistics = np.empty((repetitions, len(sample_sizes)))
+    null_chunk_size = max(1, min(repetitions, memory_budget
+                                 // (len(sample_sizes) * len(probabilities) * 8 * 2)))
+    for start in np.arange(0, repetitions, null_chunk_size):
+        stop = min(start + null_chunk_size, repetitions)
+        null_counts = rng.multinomial(sample_sizes, probabilities,
+                                      size=(stop - start, len(sample_sizes)))
+        null_statistics[start:stop] = statistic(null_counts / sample_sizes[:, np.newaxis],
+                                                probabilities, sample_sizes)
+    null_statistics.partition(repetitions - allowed - 1, axis=0)
+    cutoffs = null_statistics[repetitions - allowed - 1]
+    slack = 1e-9 * np.maximum(np.abs(cutoffs), 1)
+
+    shape = (len(alternatives), len(sample_sizes))
+    chunk_size = max(1, min(repetitions,
+                            memory_budget // (np.prod(shape) * len(probabilities) * 8 * 2)))
+    rejections = np.zeros(shape, dtype=np.int64)
+    for start in np.arange(0, repetitions, chunk_size):
+        count = min(chunk_size, repetitions - start)
+        counts = rng.multinomial(sample_sizes, alternatives[:, np.newaxis, :],
+                                 size=(count,) + shape)
+        statistics = statistic(counts / sample_sizes[:, np.newaxis], probabilities,
+                               sample_sizes)
+        rejections += np.count_nonzero(statistics > cutoffs + slack, axis=0)
+    return rejections / repetitions
+
+
+def binomial_distribution(sample_size, probability):
+    """Returns the chances of the counts 0, 1, ..., sample_size of successes
+    in sample_size independent trials with the given chance of success"""
+    counts = np.arange(sample_size + 1)
+    if probability in (0, 1):
+        return (counts == sample_size * probability).astype(float)
+    log_factorials = np.append(0, np.cumsum(np.log(np.arange(1, sample_size + 1))))
+    log_combinations = log_factorials[sample_size] - log_factorials - log_factorials[::-1]
+    return np.exp(log_combinations + counts * np.log(probability)
+                  + (sample_size - counts) * np.log1p(-probability))
+
+
+def binomial_p_value(count, sample_size, probability, alternative):
+    """Returns the exact P-value of a count of successes in sample_size
+    trials, under the model that each trial succeeds with the given chance:
+    alternative: 'less' if small counts favor the alternative hypothesis,
+        'greater' if large counts do
+    """
+    chances = binomial_distribution(sample_size, probability)
+    if alternative == 'less':
+        return chances[:count + 1].sum()
+    if alternative == 'greater':
+        return chances[count:].sum()
+    raise ValueError(f"unknown alternative: {alternative!r}")
+
+
+def chi_square_tail(x, degrees_of_freedom):
+    """Returns the chance that a chi-square variable with an integer number
+    of degrees of freedom is at least x (x may be an array)"""
+    x = np.maximum(np.asarray(x, dtype=float), 0)
+    half = x / 2
+    # The terms (x/2)**j / j! of the series for the gamma distribution,
+    # from j = 0 for even degrees of freedom or j = 1/2 for odd ones
+    if degrees_of_freedom % 2 == 0:
+        tail = np.zeros_like(x)
+        term = np.ones_like(x)
+        for j in np.arange(1, degrees_of_freedom // 2 + 1):
+            tail += term
+            term = term * half / j
+        return np.exp(-half) * tail
+    normal_tail = 2 * (1 - np.vectorize(NormalDist().cdf)(np.sqrt(x)))
+    tail = np.zeros_like(x)
+    term = np.sqrt(2 * x / np.pi)
+    for j in np.arange(1, degrees_of_freedom // 2 + 1):
+        tail += term
+        term = term * x / (2 * j + 1)
+    return normal_tail + np.exp(-half) * tail
+
+
+def gamma_tail(x, shape):
+    """Returns the chance that a gamma variable with the given shape and
+    scale 1 is at least x (x may be an array)"""
+    x = np.maximum(np.asarray(x, dtype=float), 0)
+    scale = np.exp(-x + shape * np.log(np.where(x > 0, x, 1)) - lgamma(shape))
+    series = x < shape + 1
+
+    # Below shape + 1 the series for the lower tail converges quickly, and
+    # above it the continued fraction for the upper tail does (Lentz's
+    # method, as in Numerical Recipes)
+    term = np.full_like(x, 1 / shape)
+    lower = term.copy()
+    tiny = 1e-300
+    b = x + 1 - shape
+    c = np.full_like(x, 1 / tiny)
+    d = 1 / np.where(b == 0, tiny, b)
+    fraction = d.copy()
+    for i in np.arange(1, 300):
+        term = term * x / (shape + i)
+        lower += term
+        a = -i * (i - shape)
+        b = b + 2
+        d = a * d + b
+        d = 1 / np.where(d == 0, tiny, d)
+        c = b + a / c
+        c = np.where(c == 0, tiny, c)
+        fraction *= d * c
+    tail = np.where(series, 1 - scale * lower, scale * fraction)
+    return np.where(x > 0, np.clip(tail, 0, 1), 1.0)
+
+
+def chi_square_approximation(probabilities, sample_size):
+    """Returns a function that gives the approximate chance of a chi-square
+    or G statistic at least as large as its argument: the chi-square
+    distribution with (number of categories - 1) degrees of freedom"""
+    return lambda x: chi_square_tail(x, len(probabilities) - 1)
+
+
+def tvd_approximation(probabilities, sample_size):
+    """Returns a function that gives the approximate chance of a total
+    variation distance at least as large as its argument: a gamma
+    distribution with the mean and SD of the distance in large samples"""
+    # In large samples, sqrt(sample_size) * (proportions - probabilities)
+    # is normal with these SDs and correlations, and the distance is half
+    # the sum of the absolute values
+    sds = np.sqrt(probabilities * (1 - probabilities))
+    correlations = -np.sqrt(np.outer(probabilities, probabilities)
+                            / np.outer(1 - probabilities, 1 - probabilities))
+    np.fill_diagonal(correlations, 1)
+    correlations = np.clip(correlations, -1, 1)
+    mean = np.sqrt(2 / np.pi) * sds.sum() / 2
+    # The expected product of the absolute values of two standard normal
+    # variables with correlation r is (2/pi) (sqrt(1 - r**2) + r arcsin(r))
+    products = (2 / np.pi) * (np.sqrt(1 - correlations ** 2)
+                              + correlations * np.arcsin(correlations))
+    variance = (np.outer(sds, sds) * products).sum() / 4 - mean ** 2
+
+    shape = mean ** 2 / variance
+    scale = variance / mean
+    return lambda x: gamma_tail(np.sqrt(sample_size) * np.asarray(x) / scale, shape)
+
+
+# Statistics with an approximate distribution under the model: the name of
+# the approximation, and a function of the chances and the sample size that
+# returns the approximate chance of the statistic or more
+APPROXIMATIONS = {
+    'chi-square': ('chi-square', chi_square_approximation),
+    'g': ('chi-square', chi_square_approximation),
+    'tvd': ('gamma', tvd_approximation),
+}
+
+
+def model_test(observed, probabilities, sample_size, statistic='tvd', repetitions=10000,
+               calibration=None, tolerance=0.01, seed=None):
+    """Returns the P-value of a test of whether a sample looks like a random
+    sample from a distribution, the way it was computed ('exact', the name
+    of an approximation in APPROXIMATIONS, or 'monte carlo'), and the
+    largest error of the approximation found by a calibration simulation
+    (0 when exact, and None when no approximation was tried):
+    observed: array of the proportions in each category in the sample
+    probabilities: array of the chances of the categories under the model
+    sample_size: number of draws in the sample
+    statistic: name of a statistic in GOODNESS_OF_FIT_STATISTICS
+    repetitions: number of samples to simulate if the P-value cannot be
+        computed without simulation
+    calibration: number of samples simulated to check the approximation;
+        CALIBRATION_FRACTION of repetitions by default
+    tolerance: largest acceptable error of the approximation
+    seed: seed for the random draws
+
+    With two categories the P-value is computed exactly from the binomial
+    distribution. With more, statistics in APPROXIMATIONS use their
+    approximation if it agrees with the calibration simulation at the
+    chances in CALIBRATION_LEVELS and at the observed statistic. At each of
+    these points, the approximate chance may differ from the simulated one
+    by tolerance plus the simulation's own noise there (its 95% margin,
+    shared among the points), so the approximation is used whenever it is
+    within tolerance, whatever the seed, unless it is close to the limit.
+    Every other case is simulated as in goodness_of_fit_test.
+    """
+    if statistic not in GOODNESS_OF_FIT_STATISTICS:
+        raise ValueError(f"unknown statistic: {statistic!r}")
+    statistic_of = GOODNESS_OF_FIT_STATISTICS[statistic]
+    observed = np.asarray(observed, dtype=float)
+    probabilities = np.asarray(probabilities, dtype=float)
+    observed_statistic = statistic_of(observed, probabilities, sample_size)
+    slack = 1e-9 * max(abs(observed_statistic), 1)
+
+    if len(probabilities) == 2:
+        # Every possible sample, with its chance under the model
+        counts = np.arange(sample_size + 1)
+        possible = np.column_stack([counts, sample_size - counts]) / sample_size
+        chances = binomial_distribution(sample_size, probabilities[0])
+        extreme = statistic_of(possible, probabilities, sample_size) >= observed_statistic - slack
+        return chances[extreme].sum(), 'exact', 0.0
+
+    rng = np.random.default_rng(seed)
+    error = None
+    if statistic in APPROXIMATIONS:
+        method, approximation = APPROXIMATIONS[statistic]
+        tail = approximation(probabilities, sample_size)
+        if calibration is None:
+            calibration = max(1, int(CALIBRATION_FRACTION * repetitions))
+        simulated = np.sort(statistic_of(sample_proportions(sample_size, probabilities,
+                                                            calibration, rng),
+                                         probabilities, sample_size))
+        # The simulated values with each chance in CALIBRATION_LEVELS of
+        # being exceeded, and the observed statistic with the proportion of
+        # simulated values at least as large
+        ranks = np.ceil((1 - CALIBRATION_LEVELS) * calibration).astype(int) - 1
+        points = np.append(simulated[ranks], observed_statistic)
+        empirical = np.append(CALIBRATION_LEVELS,
+                              1 - np.searchsorted(simulated, observed_statistic - slack)
+                              / calibration)
+        approximate = tail(points)
+        # 95% margin of each simulated chance, with at least one sample's
+        # worth of chance so that a tail empty of simulated values counts
+        z = NormalDist().inv_cdf(1 - 0.05 / (2 * len(points)))
+        chances = np.maximum(np.maximum(empirical, approximate), 1 / calibration)
+        noise = z * np.sqrt(chances * (1 - chances) / calibration)
+        differences = np.abs(approximate - empirical)
+        error = differences.max()
+        if np.all(differences <= tolerance + noise):
+            return tail(observed_statistic)[()], method, error
+
+    p_values, _ = goodness_of_fit_test(observed, probabilities, sample_size, repetitions,
+                                       [statistic], rng)
+    return p_values[statistic], 'monte carlo', error
+
+
+def group_codes(labels):
+    """Returns the labels coded as integers 0, 1, ..., k-1, in the sorted
+    order of the labels, and the array of the k labels"""
+    groups, codes = np.unique(np.asarray(labels), return_inverse=True)
+    dtype = np.int8 if len(groups) <= np.iinfo(np.int8).max else np.int32
+    return codes.astype(dtype), groups
+
+
+def group_sums(permuted, values, k):
+    """Returns the sum of the values in each of k groups, one row of sums
+    per row of permuted group codes"""
+    count = len(permuted)
+    flat = permuted + k * np.arange(count)[:, np.newaxis]
+    weights = np.broadcast_to(values, permuted.shape).ravel()
+    return np.bincount(flat.ravel(), weights=weights, minlength=count * k).reshape(count, k)
+
+
+def f_statistics(permuted, values, k):
+    """Returns the F statistic (the ratio of the mean squares between and
+    within groups) for each row of permuted group codes"""
+    n = len(values)
+    sizes = np.bincount(permuted[0], minlength=k)
+    deviations = values - values.mean()
+    sums = group_sums(permuted, deviations, k)
+    between = (sums ** 2 / sizes).sum(axis=1)
+    within = (deviations ** 2).sum() - between
+    return (between / (k - 1)) / (within / (n - k))
+
+
+def group_tvd_statistics(permuted, categories, k):
+    """Returns the total variation distance between the distribution of
+    the categories (coded 0, 1, ..., m-1) in each group and in the whole
+    sample, averaged over the groups weighted by their sizes, for each row
+    of permuted group codes"""
+    n = len(categories)
+    m = categories.max() + 1
+    count = len(permuted)
+    sizes = np.bincount(permuted[0], minlength=k)
+    flat = (permuted + k * np.arange(count)[:, np.newaxis]) * m + categories
+    counts = np.bincount(flat.ravel(), minlength=count * k * m).reshape(count, k, m)
+    overall = np.bincount(categories, minlength=m) / n
+    distances = 0.5 * np.abs(counts / sizes[:, np.newaxis] - overall).sum(axis=2)
+    return distances @ (sizes / n)
+
+
+def k_group_permutation_test(table, label, group_label, repetitions, statistic='f',
+                             seed=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Returns the P-value of a permutation test of whether a variable has
+    the same distribution in any number of groups, and the statistics
+    simulated under the null hypothesis:
+    table: table of data
+    label: label of the column containing the variable
+    group_label: label of the column containing the group labels
+    repetitions: number of shuffles
+    statistic: 'f' to compare the means of a numerical variable, or 'tvd'
+        to compare the distributions of a categorical variable; large
+        values of either favor the alternative
+    seed: seed for the random shuffles
+    memory_budget: number of bytes the shuffled labels may use at once
+    """
+    codes, groups = group_codes(table[group_label])
+    k = len(groups)
+    if statistic == 'f':
+        values = np.asarray(table[label], dtype=float)
+        statistics_of = f_statistics
+    elif statistic == 'tvd':
+        values = group_codes(table[label])[0].astype(np.intp)
+        statistics_of = group_tvd_statistics
+    else:
+        raise ValueError(f"unknown statistic: {statistic!r}")
+
+    observed = statistics_of(codes[np.newaxis, :], values, k)[0]
+    rng = np.random.default_rng(seed)
+    # The shuffled codes, and the group sums' flattened positions and
+    # weights, for each shuffle
+    chunk_size = max(1, min(repetitions, memory_budget // (len(values) * (1 + 8 + 8))))
+    # One preallocated copy of the codes per shuffle, reshuffled in place
+    # for each chunk; a random shuffle of any arrangement of the codes is a
+    # random shuffle of the codes
+    shuffled = np.tile(codes, (chunk_size, 1))
+    simulated = np.empty(repetitions)
+    for start in np.arange(0, repetitions, chunk_size):
+        stop = min(start + chunk_size, repetitions)
+        rows = shuffled[:stop - start]
+        rng.permuted(rows, axis=1, out=rows)
+        simulated[start:stop] = statistics_of(rows, values, k)
+
+    slack = 1e-9 * max(abs(observed), 1)
+    return np.count_nonzero(simulated >= observed - slack) / repetitions, simulated
@@ -0,0 +1,682 @@
+"""Vectorized permutation tests shared by the notebooks in chapter 12.
+
+Instead of shuffling a table and grouping it once per repetition, the engine
+encodes the group labels as 0/1 indicators, shuffles a whole block of
+copies of them at once (one permutation per row), and computes the group
+sums for every permutation with one matrix product against the values.
+Several variables can share the same shuffles: the product is then taken
+against a matrix with one column per variable.
+
+When there are few enough ways to assign the labels, the null distribution
+can be computed exactly by enumerating all of them instead, and when the
+values are all 0 or 1 it is hypergeometric and needs no shuffling at all.
+"""
+
+from math import comb
+from statistics import NormalDist
+
+import matplotlib.pyplot as plots
+import numpy as np
+
+# Default number of bytes the permutation buffers may occupy at once
+DEFAULT_MEMORY_BUDGET = 64 * 2**20
+
+# Largest number of label assignments that permutation_test enumerates
+# before it falls back to random shuffles
+DEFAULT_EXACT_LIMIT = 10**6
+
+
+def group_indicator(labels):
+    """Returns an array that is 1 for the rows in the second of two groups
+    and 0 for the rest, along with the two group labels in sorted order
+    (the order used by groupby)"""
+    groups, codes = np.unique(np.asarray(labels), return_inverse=True)
+    if len(groups) != 2:
+        raise ValueError(f"expected 2 groups, found {len(groups)}")
+    return codes.astype(np.int8), groups
+
+
+def chunk_size_for(memory_budget, n):
+    """Returns the number of permutations of n labels that fit in a memory
+    budget, counting the shuffled labels and a floating point copy"""
+    return max(1, int(memory_budget // (n * (1 + 8))))
+
+
+def differences_of_means(permuted, values, total, group_size):
+    """Returns the difference between the means of the two groups for each
+    row of permuted 0/1 indicators:
+    permuted: 2-D array with one permutation of the indicators per row
+    values: array of values, in the same order as the indicators, or a
+        2-D array with one column of values per variable
+    total: sum of all the values (of each variable)
+    group_size: number of 1's in each row
+
+    With several variables, there is one column of differences for each.
+    """
+    second = permuted @ values
+    first = total - second
+    return second / group_size - first / (len(values) - group_size)
+
+
+def stratum_layout(strata):
+    """Returns the order that sorts the rows by stratum, and the integer
+    code of the stratum of each row in that order"""
+    _, codes = np.unique(np.asarray(strata), return_inverse=True)
+    order = np.argsort(codes, kind='stable')
+    return order, codes[order]
+
+
+class LabelShuffler:
+    """Random shuffles of one array of integer labels, made a batch at a
+    time in a single preallocated (batch_size x n) array that is reshuffled
+    in place, so that no memory is allocated for each batch:
+    labels: array of integer labels, such as the indicator of
+        group_indicator
+    batch_size: largest number of shuffles in a batch
+    rng: random number generator
+
+    The arrays returned are read-only views of the preallocated ones, and
+    are overwritten by the next batch.
+    """
+
+    def __init__(self, labels, batch_size, rng):
+        self.rng = rng
+        self._labels = np.tile(np.asarray(labels), (batch_size, 1))
+        self._floats = np.empty(self._labels.shape)
+
+    def shuffle(self, count=None):
+        """Returns count new shuffles of the labels, one per row (all
+        batch_size of them by default)"""
+        rows = self._labels[:count]
+        # A uniformly random shuffle of any arrangement of the labels is a
+        # uniformly random shuffle of the labels
+        self.rng.permuted(rows, axis=1, out=rows)
+        view = rows.view()
+        view.flags.writeable = False
+        return view
+
+    def shuffle_floats(self, count=None):
+        """Returns count new shuffles of the labels as floats, ready for
+        matrix products with the values"""
+        floats = self._floats[:count]
+        np.copyto(floats, self.shuffle(count))
+        view = floats.view()
+        view.flags.writeable = False
+        return view
+
+
+def _stratified_differences(rng, indicator, strata, count, values, total, group_size):
+    """Returns the differences between the group means for count random
+    shuffles of the 0/1 labels in indicator within the strata (the sorted
+    stratum codes of stratum_layout)"""
+    # Random keys between code and code + 1 sort each stratum's block of
+    # positions into a random order without moving it
+    keys = rng.random((count, len(indicator))) + strata
+    permuted = indicator[np.argsort(keys, axis=1)]
+    return differences_of_means(permuted.astype(float), values, total, group_size)
+
+
+def simulated_differences(table, label, group_label, repetitions, seed=None,
+                          memory_budget=DEFAULT_MEMORY_BUDGET, strata=None):
+    """Returns an array of differences between the means of two groups,
+    simulated under the null hypothesis by shuffling the group labels:
+    table: table of data
+    label: label of the column containing the numerical variable, or a
+        list of labels; every variable is tested on the same shuffles and
+        the result has one row of differences per variable
+    group_label: label of the column containing the two group labels
+    repetitions: number of shuffles
+    seed: seed for the random shuffles
+    memory_budget: number of bytes the shuffled labels may use at once
+    strata: label of a column of strata (blocks); if given, the group
+        labels are shuffled only among rows in the same stratum
+
+    Each difference is the mean of the second group minus the mean of the
+    first, in the sorted order of the labels, like difference_of_means.
+    """
+    values = np.asarray(table[label], dtype=float)
+    indicator, groups = group_indicator(table[group_label])
+    total = values.sum(axis=0)
+    group_size = np.count_nonzero(indicator)
+    rng = np.random.default_rng(seed)
+
+    width = len(values)
+    stratum_codes = None
+    if strata is not None:
+        order, stratum_codes = stratum_layout(table[strata])
+        values, indicator = values[order], indicator[order]
+        # The random keys and their sorting order take about twice as much
+        # memory again as the shuffled labels
+        width = 3 * width
+
+    chunk_size = max(1, min(repetitions, chunk_size_for(memory_budget, width)))
+    if strata is None:
+        shuffler = LabelShuffler(indicator, chunk_size, rng)
+    differences = np.empty((repetitions,) + values.shape[1:])
+    for start in np.arange(0, repetitions, chunk_size):
+        stop = min(start + chunk_size, repetitions)
+        if strata is None:
+            permuted = shuffler.shuffle_floats(stop - start)
+            differences[start:stop] = differences_of_means(permuted, values, total, group_size)
+        else:
+            differences[start:stop] = _stratified_differences(
+                rng, indicator, stratum_codes, stop - start, values, total, group_size
+            )
+
+    return differences.T
+
+
+class NullDistribution:
+    """Summary of statistics simulated under a null hypothesis, updated one
+    batch at a time so that memory does not grow with the number of
+    simulations:
+    bins: array of bin edges for the histogram, as in plots.hist; values
+        outside the bins are counted as below or above them
+    observed: the observed statistic, for the empirical P-values
+    sketch_size: if given, a uniform random sample of this many of the
+        statistics is kept for quantiles; otherwise quantiles are
+        interpolated from the histogram
+    seed: seed for the random sample of statistics
+    slack: allowance for rounding when comparing statistics with the
+        observed one, so that ties count as at least as extreme; defaults
+        to 1e-9 times the largest of the observed statistic and the bin
+        edges in size
+
+    The P-values use the same comparisons as permutation_test, so with the
+    same slack, streaming a simulation gives the same P-value as storing
+    all of its statistics.
+    """
+
+    def __init__(self, bins, observed=None, sketch_size=None, seed=None, slack=None):
+        self.bins = np.asarray(bins, dtype=float)
+        self.counts = np.zeros(len(self.bins) - 1, dtype=np.int64)
+        self.below = 0
+        self.above = 0
+        self.observed = observed
+        if slack is None and observed is not None:
+            slack = 1e-9 * max(abs(observed), np.abs(self.bins).max())
+        self.slack = slack
+        self.at_least = 0
+        self.at_most = 0
+        self.at_least_in_size = 0
+        self.repetitions = 0
+        self._mean = 0.0
+        self._sum_of_squares = 0.0
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.sketch_size = sketch_size
+        self._rng = np.random.default_rng(seed)
+        self._sketch = np.empty(0)
+        self._keys = np.empty(0)
+
+    def update(self, statistics):
+        """Adds a batch of simulated statistics to the summary"""
+        statistics = np.ravel(np.asarray(statistics, dtype=float))
+        count = len(statistics)
+        if count == 0:
+            return self
+
+        self.counts += np.histogram(statistics, bins=self.bins)[0]
+        self.below += np.count_nonzero(statistics < self.bins[0])
+        self.above += np.count_nonzero(statistics > self.bins[-1])
+
+        if self.observed is not None:
+            slack = self.slack
+            self.at_least += np.count_nonzero(_extreme(statistics, self.observed, 'greater', slack))
+            self.at_most += np.count_nonzero(_extreme(statistics, self.observed, 'less', slack))
+            self.at_least_in_size += np.count_nonzero(
+                _extreme(statistics, self.observed, 'two-sided', slack))
+
+        # Combine the running mean and sum of squared deviations with those
+        # of the batch (Chan, Golub and LeVeque)
+        batch_mean = statistics.mean()
+        batch_sum_of_squares = ((statistics - batch_mean) ** 2).sum()
+        total = self.repetitions + count
+        delta = batch_mean - self._mean
+        self._sum_of_squares += batch_sum_of_squares + delta ** 2 * self.repetitions * count / total
+        self._mean += delta * count / total
+        self.repetitions = total
+        self.minimum = min(self.minimum, statistics.min())
+        self.maximum = max(self.maximum, statistics.max())
+
+        # Keep the statistics with the smallest random keys, which are a
+        # uniform random sample of all the statistics seen so far
+        if self.sketch_size:
+            keys = np.append(self._keys, self._rng.random(count))
+            sketch = np.append(self._sketch, statistics)
+            if len(keys) > self.sketch_size:
+                kept = np.argpartition(keys, self.sketch_size)[:self.sketch_size]
+                keys, sketch = keys[kept], sketch[kept]
+            self._keys, self._sketch = keys, sketch
+        return self
+
+    def p_value(self, alternative):
+        """Returns the empirical P-value of the observed statistic:
+        alternative: 'greater', 'less' or 'two-sided', as in permutation_test
+        """
+        if self.observed is None:
+            raise ValueError("no observed statistic to compare with")
+        exceedances = {
+            'greater': self.at_least,
+            'less': self.at_most,
+            'two-sided': self.at_least_in_size,
+        }
+        if alternative not in exceedances:
+            raise ValueError(f"unknown alternative: {alternative!r}")
+        return exceedances[alternative] / self.repetitions
+
+    def mean(self):
+        """Returns the mean of the statistics"""
+        return self._mean
+
+    def std(self):
+        """Returns the standard deviation of the statistics, like np.std"""
+        return np.sqrt(self._sum_of_squares / self.repetitions)
+
+    def quantile(self, q):
+        """Returns the q quantile(s) of the statistics, for q between 0 and 1"""
+        if self.sketch_size:
+            return np.quantile(self._sketch, q)
+        cumulative = np.cumsum(np.append(self.below, self.counts)) / self.repetitions
+        return np.interp(q, cumulative, self.bins)
+
+    def plot(self, **options):
+        """Draws the histogram of the statistics; options are passed to
+        plots.hist"""
+        options.setdefault('ec', 'white')
+        plots.hist(self.bins[:-1], bins=self.bins, weights=self.counts, **options)
+
+
+def streamed_differences(table, label, group_label, repetitions, bins, seed=None,
+                         sketch_size=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Returns a NullDistribution of differences between the means of two
+    groups, simulated by shuffling the group labels like
+    simulated_differences but without storing the differences:
+    table: table of data
+    label: label of the column containing the numerical variable
+    group_label: label of the column containing the two group labels
+    repetitions: number of shuffles
+    bins: array of bin edges for the histogram of the differences
+    seed: seed for the random shuffles
+    sketch_size: number of differences to keep for quantiles, if any
+    memory_budget: number of bytes the shuffled labels may use at once
+
+    The observed difference is recorded for the P-values, which allow for
+    rounding the same way as permutation_test. With the same seed and
+    memory_budget, the shuffles are the same as those of
+    simulated_differences.
+    """
+    values = np.asarray(table[label], dtype=float)
+    indicator, groups = group_indicator(table[group_label])
+    total = values.sum()
+    group_size = np.count_nonzero(indicator)
+    observed = differences_of_means(indicator[np.newaxis, :].astype(float), values,
+                                    total, group_size)[0]
+    rng = np.random.default_rng(seed)
+    null = NullDistribution(bins, observed=observed, sketch_size=sketch_size,
+                            seed=rng.spawn(1)[0], slack=1e-9 * np.abs(values).max())
+
+    chunk_size = max(1, min(repetitions, chunk_size_for(memory_budget, len(values))))
+    shuffler = LabelShuffler(indicator, chunk_size, rng)
+    for start in np.arange(0, repetitions, chunk_size):
+        permuted = shuffler.shuffle_floats(min(chunk_size, repetitions - start))
+        null.update(differences_of_means(permuted, values, total, group_size))
+    return null
+
+
+def revolving_door_swaps(n, k):
+    """Returns two arrays, the elements moved in and the elements moved out,
+    that step through every subset of size k of range(n), starting from
+    range(k), changing one element at a time (revolving door order)"""
+    if k == 0 or k == n:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+
+    # The swaps for subsets of size j of range(m + 1) are those of range(m),
+    # then m in for j - 2 out, then the swaps for subsets of size j - 1
+    # of range(m) backwards with in and out exchanged. So the swaps for
+    # range(m) are the first comb(m, j) - 1 of those for any larger range,
+    # and each size j is built from one array for size j - 1.
+    largest = n - k + 1
+    moved_in, moved_out = np.arange(1, largest), np.arange(0, largest - 1)
+    for j in np.arange(2, k + 1):
+        largest += 1
+        ins, outs = [], []
+        for m in np.arange(j, largest):
+            steps = comb(int(m), int(j) - 1) - 1
+            ins += [[m], moved_out[:steps][::-1]]
+            outs += [[j - 2], moved_in[:steps][::-1]]
+        moved_in = np.concatenate(ins).astype(np.intp)
+        moved_out = np.concatenate(outs).astype(np.intp)
+    return moved_in, moved_out
+
+
+def exact_sums(values, group_size):
+    """Returns the sum of every possible group of group_size of the values
+    (with one column of sums per column of a 2-D array of values)"""
+    n = len(values)
+    total = values.sum(axis=0)
+
+    # Enumerate whichever group is smaller; each step of the revolving door
+    # changes its sum by one value in and one value out
+    enumerated = min(group_size, n - group_size)
+    moved_in, moved_out = revolving_door_swaps(n, enumerated)
+    steps = values[moved_in] - values[moved_out]
+    start = np.zeros((1,) + values.shape[1:])
+    sums = values[:enumerated].sum(axis=0) + np.concatenate([start, np.cumsum(steps, axis=0)])
+    if enumerated != group_size:
+        sums = total - sums
+    return sums
+
+
+def exact_differences(values, indicator, strata=None):
+    """Returns the difference between the group means for every possible
+    assignment of the 0/1 labels in indicator to the values (or, for a 2-D
+    array of values, one row of such differences per column); if strata
+    are given, only assignments that keep the number of 1's in each
+    stratum are counted"""
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    group_size = int(np.count_nonzero(indicator))
+    total = values.sum(axis=0)
+
+    if strata is None:
+        sums = exact_sums(values, group_size)
+    else:
+        # Every combination of one assignment per stratum: the group sum
+        # is the sum of the strata's group sums
+        strata = np.asarray(strata)
+        sums = np.zeros((1,) + values.shape[1:])
+        for stratum in np.unique(strata):
+            rows = strata == stratum
+            stratum_sums = exact_sums(values[rows], int(np.count_nonzero(indicator[rows])))
+            sums = (sums[:, np.newaxis] + stratum_sums[np.newaxis, :]).reshape(
+                (-1,) + values.shape[1:])
+    return (sums / group_size - (total - sums) / (n - group_size)).T
+
+
+def exact_count(indicator, strata=None):
+    """Returns the number of assignments exact_differences enumerates"""
+    if strata is None:
+        return comb(len(indicator), int(np.count_nonzero(indicator)))
+    strata = np.asarray(strata)
+    count = 1
+    for stratum in np.unique(strata):
+        rows = strata == stratum
+        count *= comb(int(np.count_nonzero(rows)), int(np.count_nonzero(indicator[rows])))
+    return count
+
+
+def is_binary(values):
+    """Returns True if every value is 0 or 1 (or False or True)"""
+    return bool(np.isin(np.asarray(values), [0, 1]).all())
+
+
+def hypergeometric_null(values, indicator):
+    """Returns the possible differences between the proportions of 1's in
+    the two groups, and the chance of each under the null hypothesis:
+    values: array of 0's and 1's
+    indicator: array of 0/1 group labels, in the same order as values
+    """
+    n = len(values)
+    ones = int(np.count_nonzero(values))
+    group_size = int(np.count_nonzero(indicator))
+
+    # The number of 1's that land in the second group is hypergeometric;
+    # successive chances differ by a simple ratio
+    smallest = max(0, group_size + ones - n)
+    largest = min(group_size, ones)
+    counts = np.arange(smallest, largest + 1)
+    ratios = ((ones - counts[:-1]) * (group_size - counts[:-1])
+              / ((counts[:-1] + 1) * (n - ones - group_size + counts[:-1] + 1)))
+    log_chances = np.concatenate([[0], np.cumsum(np.log(ratios))])
+    chances = np.exp(log_chances - log_chances.max())
+    chances = chances / chances.sum()
+
+    differences = counts / group_size - (ones - counts) / (n - group_size)
+    return differences, chances
+
+
+def _extreme(differences, observed, alternative, slack):
+    """Returns a Boolean array marking the differences at least as extreme
+    as the observed one, allowing for rounding so that ties count; with
+    one row of differences per variable, observed has one entry per row"""
+    if np.ndim(observed) == 1:
+        observed = observed[:, np.newaxis]
+    if alternative == 'greater':
+        return differences >= observed - slack
+    if alternative == 'less':
+        return differences <= observed + slack
+    if alternative == 'two-sided':
+        return np.abs(differences) >= abs(observed) - slack
+    raise ValueError(f"unknown alternative: {alternative!r}")
+
+
+def permutation_test(table, label, group_label, alternative, repetitions=10000,
+                     method='auto', exact_limit=DEFAULT_EXACT_LIMIT, seed=None,
+                     simulate=False, strata=None):
+    """Returns the P-value of a permutation test of the difference between
+    the means of two groups, and the differences simulated (or enumerated)
+    under the null hypothesis:
+    table: table of data
+    label: label of the column containing the numerical variable, or a
+        list of labels; every variable is then tested on the same shuffles,
+        and there is one P-value and one row of differences per variable
+    group_label: label of the column containing the two group labels
+    alternative: 'greater' or 'less' if large or small differences favor
+        the alternative hypothesis, or 'two-sided' if large distances do
+    repetitions: number of shuffles when the test is not exact
+    method: 'exact' to enumerate every assignment of the labels,
+        'hypergeometric' to compute the null distribution directly when
+        the variable is 0/1, 'monte carlo' to shuffle the labels at random,
+        or 'auto' to use 'hypergeometric' for a 0/1 variable, 'exact' when
+        there are at most exact_limit assignments, and 'monte carlo'
+        otherwise
+    exact_limit: largest number of assignments 'auto' enumerates
+    seed: seed for the random shuffles
+    simulate: with the 'hypergeometric' method, the P-value needs no
+        shuffles and the differences returned are None unless simulate is
+        True, in which case repetitions shuffles are drawn for a histogram
+    strata: label of a column of strata (blocks); if given, the labels are
+        shuffled (or enumerated) only among rows in the same stratum, and
+        the 'hypergeometric' method is not available
+
+    The difference is the mean of the second group minus the mean of the
+    first, in the sorted order of the labels, like difference_of_means.
+    """
+    values = np.asarray(table[label], dtype=float)
+    indicator, groups = group_indicator(table[group_label])
+    group_size = np.count_nonzero(indicator)
+    observed = differences_of_means(indicator[np.newaxis, :].astype(float), values,
+                                    values.sum(axis=0), group_size)[0]
+    slack = 1e-9 * np.abs(values).max()
+
+    stratum_labels = None if strata is None else np.asarray(table[strata])
+    if method == 'auto':
+        assignments = exact_count(indicator, stratum_labels)
+        if is_binary(values) and strata is None:
+            method = 'hypergeometric'
+        elif assignments <= exact_limit:
+            method = 'exact'
+        else:
+            method = 'monte carlo'
+
+    if method == 'hypergeometric':
+        if not is_binary(values):
+            raise ValueError("the hypergeometric method needs a 0/1 variable")
+        if strata is not None:
+            raise ValueError("the hypergeometric method does not allow strata")
+        columns = values.reshape(len(values), -1).T
+        p_values = []
+        for column, column_observed in zip(columns, np.reshape(observed, -1)):
+            possible, chances = hypergeometric_null(column, indicator)
+            p_values.append(chances[_extreme(possible, column_observed, alternative, slack)].sum())
+        p_value = p_values[0] if values.ndim == 1 else np.array(p_values)
+        differences = None
+        if simulate:
+            differences = simulated_differences(table, label, group_label, repetitions, seed=seed)
+        return p_value, differences
+
+    if method == 'exact':
+        differences = exact_differences(values, indicator, stratum_labels)
+    elif method == 'monte carlo':
+        differences = simulated_differences(table, label, group_label, repetitions, seed=seed,
+                                            strata=strata)
+    else:
+        raise ValueError(f"unknown method: {method!r}")
+    extreme = _extreme(differences, observed, alternative, slack)
+    return np.count_nonzero(extreme, axis=-1) / differences.shape[-1], differences
+
+
+def sequential_permutation_test(table, label, group_label, alternative,
+                                repetitions=100000, exceedances=None, alpha=None,
+                                error=0.001, batch_size=1000, seed=None):
+    """Returns the P-value of a permutation test of the difference between
+    the means of two groups, its Monte Carlo standard error, and the number
+    of shuffles used, shuffling only until the answer is clear:
+    table: table of data
+    label: label of the column containing the numerical variable
+    group_label: label of the column containing the two group labels
+    alternative: 'greater', 'less' or 'two-sided', as in permutation_test
+    repetitions: largest number of shuffles
+    exceedances: stop once this many shuffles have given a difference at
+        least as extreme as the observed one (Besag and Clifford); 10 by
+        default, and not allowed with alpha
+    alpha: if given, stop only once it is clear whether the P-value is
+        above or below alpha
+    error: largest chance that the decision about alpha is wrong
+    batch_size: number of shuffles drawn between checks
+    seed: seed for the random shuffles
+
+    With alpha, the P-value is checked after every batch, so there are up
+    to repetitions / batch_size looks at it. Each look uses a Wilson
+    interval with error divided by that number of looks; by the union bound
+    all the intervals cover the true P-value together with chance at least
+    1 - error, so a stop says which side of alpha the P-value is on with
+    chance of being wrong at most error. If the shuffles run out first, the
+    P-value is too close to alpha to decide with that many shuffles.
+    """
+    if alpha is None and exceedances is None:
+        exceedances = 10
+    if alpha is not None and exceedances is not None:
+        raise ValueError("exceedances and alpha cannot both be given")
+    values = np.asarray(table[label], dtype=float)
+    indicator, groups = group_indicator(table[group_label])
+    total = values.sum()
+    group_size = np.count_nonzero(indicator)
+    observed = differences_of_means(indicator[np.newaxis, :].astype(float), values,
+                                     total, group_size)[0]
+    slack = 1e-9 * np.abs(values).max()
+    rng = np.random.default_rng(seed)
+    looks = -(-repetitions // batch_size)
+    z = NormalDist().inv_cdf(1 - error / (2 * looks))
+    shuffler = LabelShuffler(indicator, min(batch_size, repetitions), rng)
+
+    used = 0
+    extreme = 0
+    while used < repetitions:
+        count = min(batch_size, repetitions - used)
+        differences = differences_of_means(shuffler.shuffle_floats(count), values, total,
+                                           group_size)
+        hits = np.cumsum(_extreme(differences, observed, alternative, slack))
+
+        if alpha is None and extreme + hits[-1] >= exceedances:
+            # Stop at the shuffle that gave the last exceedance needed
+            used += int(np.searchsorted(hits, exceedances - extreme)) + 1
+            p_value = exceedances / used
+            return p_value, np.sqrt(p_value * (1 - p_value) / used), used
+
+        used += count
+        extreme += int(hits[-1])
+        if alpha is not None:
+            # Wilson interval for the P-value
+            estimate = extreme / used
+            center = (estimate + z**2 / (2 * used)) / (1 + z**2 / used)
+            half_width = (z / (1 + z**2 / used)
+                          * np.sqrt(estimate * (1 - estimate) / used + z**2 / (4 * used**2)))
+            if center + half_width < alpha or center - half_width > alpha:
+                break
+
+    p_value = (extreme + 1) / (used + 1)
+    return p_value, np.sqrt(p_value * (1 - p_value) / used), used
+
+
+def t_statistics(permuted, values, group_size):
+    """Returns the Welch t statistic of the difference between the means of
+    the two groups for each row of permuted 0/1 indicators and each column
+    of values (a 2-D array with one column per variable)"""
+    n = len(values)
+    other_size = n - group_size
+    total = values.sum(axis=0)
+    total_of_squares = (values ** 2).sum(axis=0)
+
+    second_sums = permuted @ values
+    second_squares = permuted @ (values ** 2)
+    first_sums = total - second_sums
+    first_squares = total_of_squares - second_squares
+
+    second_means = second_sums / group_size
+    first_means = first_sums / other_size
+    second_variances = (second_squares - group_size * second_means ** 2) / (group_size - 1)
+    first_variances = (first_squares - other_size * first_means ** 2) / (other_size - 1)
+    spread = np.sqrt(second_variances / group_size + first_variances / other_size)
+    return (second_means - first_means) / spread
+
+
+def max_t_test(table, labels, group_label, repetitions, alternative='two-sided',
+               seed=None, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Returns the unadjusted P-values of permutation tests of the
+    difference between the means of two groups for many variables, and
+    P-values adjusted to control the chance of any false rejection among
+    them (Westfall and Young's step-down maxT method):
+    table: table of data
+    labels: list of labels of the columns containing the variables
+    group_label: label of the column containing the two group labels
+    repetitions: number of shuffles, all shared by all the variables
+    alternative: 'greater', 'less' or 'two-sided', as in permutation_test
+    seed: seed for the random shuffles
+    memory_budget: number of bytes the shuffled labels may use at once
+
+    The test statistic is the Welch t statistic, so that variables on
+    different scales can be compared. Only counts are kept from each chunk
+    of shuffles, so memory does not grow with repetitions.
+    """
+    values = np.asarray(table[labels], dtype=float)
+    values = values - values.mean(axis=0)
+    indicator, groups = group_indicator(table[group_label])
+    group_size = np.count_nonzero(indicator)
+    columns = values.shape[1]
+    rng = np.random.default_rng(seed)
+
+    def oriented(t):
+        if alternative == 'greater':
+            return t
+        if alternative == 'less':
+            return -t
+        if alternative == 'two-sided':
+            return np.abs(t)
+        raise ValueError(f"unknown alternative: {alternative!r}")
+
+    observed = oriented(t_statistics(indicator[np.newaxis, :].astype(float), values, group_size)[0])
+    slack = 1e-9 * np.abs(observed).max()
+
+    # Step down from the most to the least significant variable: each is
+    # compared with the largest statistic among itself and the variables
+    # less significant than it
+    order = np.argsort(-observed)
+    ordered_observed = observed[order]
+
+    exceedances = np.zeros(columns, dtype=np.int64)
+    max_exceedances = np.zeros(columns, dtype=np.int64)
+    chunk_size = max(1, min(repetitions, chunk_size_for(memory_budget, len(values) + 4 * columns)))
+    shuffler = LabelShuffler(indicator, chunk_size, rng)
+    for start in np.arange(0, repetitions, chunk_size):
+        permuted = shuffler.shuffle_floats(min(chunk_size, repetitions - start))
+        simulated = oriented(t_statistics(permuted, values, group_size))
+        exceedances += np.count_nonzero(simulated >= observed - slack, axis=0)
+        successive_maxima = np.maximum.accumulate(simulated[:, order][:, ::-1], axis=1)[:, ::-1]
+        max_exceedances += np.count_nonzero(successive_maxima >= ordered_observed - slack, axis=0)
+
+    # Adjusted P-values may not decrease as the evidence gets weaker
+    adjusted = np.empty(columns)
+    adjusted[order] = np.maximum.accumulate(max_exceedances / repetitions)
+    return exceedances / repetitions, adjusted
@@ -0,0 +1,45 @@
+"""Regression checks for permutation.py"""
+
+import numpy as np
+import pandas as pd
+
+from permutation import (DEFAULT_EXACT_LIMIT, exact_count, permutation_test,
+                         sequential_permutation_test)
+
+
+def test_exact_test_of_lopsided_split():
+    # 2 against 1,198 has 719,400 assignments, under the exact limit, and
+    # enumerating them must not recurse once per row
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame({'Value': rng.normal(size=1200),
+                          'Group': np.repeat(['a', 'b'], [1198, 2])})
+    indicator = (table['Group'] == 'b').to_numpy()
+    assert exact_count(indicator) <= DEFAULT_EXACT_LIMIT
+
+    p_value, differences = permutation_test(table, 'Value', 'Group', 'greater')
+    assert differences.shape == (719400,)
+
+    # Every pair of rows, directly
+    values = table['Value'].to_numpy()
+    first, second = np.triu_indices(len(values), k=1)
+    pair_sums = values[first] + values[second]
+    expected = pair_sums / 2 - (values.sum() - pair_sums) / (len(values) - 2)
+    assert np.allclose(np.sort(differences), np.sort(expected))
+    observed = values[indicator].mean() - values[~indicator].mean()
+    assert p_value == np.count_nonzero(expected >= observed - 1e-9) / len(expected)
+
+
+def test_sequential_decision_near_alpha():
+    # The exact P-value is about 0.042, just under alpha; stopping after a
+    # few exceedances would often put the estimate above 0.05
+    rng = np.random.default_rng(0)
+    table = pd.DataFrame({'Value': rng.normal(size=16) + np.repeat([0, 1.86], 8),
+                          'Group': np.repeat(['a', 'b'], 8)})
+    exact_p_value, _ = permutation_test(table, 'Value', 'Group', 'greater', method='exact')
+    assert 0.04 < exact_p_value < 0.045
+
+    for seed in range(20):
+        p_value, _, used = sequential_permutation_test(table, 'Value', 'Group', 'greater',
+                                                       alpha=0.05, seed=seed)
+        assert used < 100000
+        assert p_value < 0.05
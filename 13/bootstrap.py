@@ -0,0 +1,801 @@
+"""Vectorized bootstrap engine shared by the notebooks in chapter 13.
+
+Instead of resampling a table one replication at a time, the engine draws a
+whole block of bootstrap samples as a (replications x sample size) matrix of
+row positions and reduces every row of the resampled values in one call.
+
+For means, proportions and medians the samples need not be materialized at
+all: a bootstrap sample is fully described by how many times it contains
+each value of the original sample, so the engine can draw those counts
+(multinomial or Poisson) and compute the statistics from them directly.
+"""
+
+import glob
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial
+from inspect import Parameter, signature
+from statistics import NormalDist
+from types import CodeType, ModuleType
+
+import matplotlib.pyplot as plots
+import numpy as np
+from matplotlib.collections import LineCollection
+
+# Default number of bytes the resampling buffers may occupy at once
+DEFAULT_MEMORY_BUDGET = 64 * 2**20
+
+# Number of replications drawn from each independent random stream
+BLOCK_SIZE = 1000
+
+# Where seeded bootstrap results are kept, and how many bytes they may use
+CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.bootstrap_cache')
+CACHE_SIZE_LIMIT = 256 * 2**20
+
+
+def medians(samples):
+    """Returns the median of each row of a 2-D array of samples"""
+    return np.percentile(samples, 50, axis=1)
+
+
+def means(samples):
+    """Returns the mean of each row of a 2-D array of samples"""
+    return np.mean(samples, axis=1)
+
+
+def proportions(samples):
+    """Returns the proportion of nonzero (True) entries in each row"""
+    return np.count_nonzero(samples, axis=1) / samples.shape[1]
+
+
+def weighted_means(counts, sorted_values):
+    """Returns the mean of each bootstrap sample described by a row of counts:
+    counts: 2-D array, one row per sample, giving how many times the sample
+        contains each value of sorted_values
+    sorted_values: the values of the original sample in increasing order
+    """
+    counts = counts.astype(float)
+    return (counts @ sorted_values.astype(float)) / counts.sum(axis=1)
+
+
+def weighted_proportions(counts, sorted_values):
+    """Returns the proportion of nonzero (True) entries in each bootstrap
+    sample described by a row of counts"""
+    counts = counts.astype(float)
+    return (counts @ (sorted_values != 0)) / counts.sum(axis=1)
+
+
+def order_statistics(cumulative, sorted_values, k):
+    """Returns the kth smallest value (counting from 0) of each bootstrap
+    sample described by a row of cumulative counts:
+    cumulative: 2-D array of running totals of the counts along each row
+    sorted_values: the values of the original sample in increasing order
+    k: array with one position per row
+    """
+    # The kth order statistic is the first sorted value whose cumulative
+    # count exceeds k. Shifting each row above the one before it makes the
+    # whole array increasing, so one searchsorted finds it for every row.
+    rows, n = cumulative.shape
+    offsets = np.arange(rows) * (cumulative[:, -1].max() + 1)
+    shifted = (cumulative + offsets[:, np.newaxis]).ravel()
+    found = np.searchsorted(shifted, k + offsets, side='right') - np.arange(rows) * n
+    return sorted_values[np.clip(found, 0, n - 1)]
+
+
+def weighted_percentiles(counts, sorted_values, p):
+    """Returns the pth percentile, as computed by np.percentile, of each
+    bootstrap sample described by a row of counts"""
+    cumulative = np.cumsum(counts, axis=1)
+    totals = cumulative[:, -1]
+
+    # np.percentile interpolates between the order statistics on either
+    # side of position (total - 1) * p / 100
+    position = (totals - 1) * p / 100
+    below = np.floor(position)
+    fraction = position - below
+    above = np.minimum(below + 1, totals - 1)
+
+    lower = order_statistics(cumulative, sorted_values, below.astype(np.intp))
+    upper = order_statistics(cumulative, sorted_values, above.astype(np.intp))
+    results = lower + fraction * (upper - lower)
+    return np.where(totals > 0, results, np.nan)
+
+
+def weighted_medians(counts, sorted_values):
+    """Returns the median of each bootstrap sample described by a row of counts"""
+    return weighted_percentiles(counts, sorted_values, 50)
+
+
+# Statistics of resampled rows and the matching statistics of counts
+WEIGHTED_STATISTICS = {
+    medians: weighted_medians,
+    means: weighted_means,
+    proportions: weighted_proportions,
+}
+
+
+def chunk_size_for(memory_budget, sample_size, itemsize):
+    """Returns the number of bootstrap samples that fit in a memory budget:
+    memory_budget: number of bytes available for the resampling buffers
+    sample_size: size of each bootstrap sample
+    itemsize: number of bytes in one value of the original sample
+    """
+    # One uniform draw and one row position per resampled value, the
+    # resampled value itself, and a copy the statistic may make of it
+    bytes_per_sample = sample_size * (2 * 8 + 2 * itemsize)
+    return max(1, int(memory_budget // bytes_per_sample))
+
+
+def _position_sampler(n, sample_size, chunk_size):
+    """Returns a function that fills a preallocated buffer with the row
+    positions of a chunk of bootstrap samples and returns a view of it"""
+    # The same buffers are refilled for every chunk
+    uniforms = np.empty((chunk_size, sample_size))
+    rows = np.empty((chunk_size, sample_size), dtype=np.intp)
+
+    def draw(rng, count):
+        rng.random(out=uniforms[:count])
+        np.multiply(uniforms[:count], n, out=uniforms[:count])
+        np.copyto(rows[:count], uniforms[:count], casting='unsafe')
+        return rows[:count]
+
+    return draw
+
+
+def _row_sampler(values, sample_size, chunk_size):
+    """Returns a function that fills preallocated buffers with a chunk of
+    bootstrap samples, one per row, and returns a view of them"""
+    draw_rows = _position_sampler(len(values), sample_size, chunk_size)
+    resamples = np.empty((chunk_size, sample_size), dtype=values.dtype)
+
+    def draw(rng, count):
+        np.take(values, draw_rows(rng, count), out=resamples[:count])
+        return resamples[:count]
+
+    return draw
+
+
+def _rank_sampler(codes, distinct, sample_size, chunk_size):
+    """Returns a function that draws a chunk of bootstrap samples the same
+    way as _row_sampler, but returns how many times each sample contains
+    each distinct value instead of the samples themselves:
+    codes: position of each original value among the distinct values
+    distinct: number of distinct values
+    """
+    draw_rows = _position_sampler(len(codes), sample_size, chunk_size)
+    ranks = np.empty((chunk_size, sample_size), dtype=np.intp)
+    offsets = (np.arange(chunk_size) * distinct)[:, np.newaxis]
+
+    def draw(rng, count):
+        # Give each row its own range of bins so that one bincount
+        # counts every row of the chunk
+        np.take(codes, draw_rows(rng, count), out=ranks[:count])
+        ranks[:count] += offsets[:count]
+        counts = np.bincount(ranks[:count].ravel(), minlength=count * distinct)
+        return counts.reshape(count, distinct)
+
+    return draw
+
+
+def _count_sampler(values, sample_size, resampling):
+    """Returns a function that draws a chunk of bootstrap samples as a
+    matrix of counts, one row per sample and one column per value"""
+    if resampling == 'multinomial':
+        probabilities = np.full(len(values), 1 / len(values))
+        return lambda rng, count: rng.multinomial(sample_size, probabilities, size=count)
+    if resampling == 'poisson':
+        rate = sample_size / len(values)
+        return lambda rng, count: rng.poisson(rate, size=(count, len(values)))
+    raise ValueError(f"unknown resampling method: {resampling!r}")
+
+
+def _bootstrap_blocks(values, statistic, sample_size, memory_budget, seeds, sizes,
+                      resampling='rows'):
+    """Returns the bootstrapped statistics for consecutive blocks of
+    replications, each block drawn from its own seed"""
+    largest = max(sizes)
+    if resampling == 'rows':
+        chunk_size = chunk_size_for(memory_budget, sample_size, values.itemsize)
+        chunk_size = max(1, min(largest, chunk_size))
+        draw_samples = _row_sampler(values, sample_size, chunk_size)
+    elif resampling == 'ranks':
+        # Sort once: each sample becomes counts of the distinct values
+        values, codes = np.unique(values, return_inverse=True)
+        chunk_size = chunk_size_for(memory_budget, sample_size + len(values), 8)
+        chunk_size = max(1, min(largest, chunk_size))
+        draw_counts = _rank_sampler(codes, len(values), sample_size, chunk_size)
+    else:
+        # One row of counts per sample, with as many columns as values
+        values = np.sort(values)
+        chunk_size = chunk_size_for(memory_budget, len(values), 8)
+        chunk_size = max(1, min(largest, chunk_size))
+        draw_counts = _count_sampler(values, sample_size, resampling)
+
+    results = np.empty(sum(sizes))
+    position = 0
+    for seed, size in zip(seeds, sizes):
+        rng = np.random.default_rng(seed)
+        for start in np.arange(0, size, chunk_size):
+            count = min(chunk_size, size - start)
+            if resampling == 'rows':
+                statistics = statistic(draw_samples(rng, count))
+            else:
+                statistics = statistic(draw_counts(rng, count), values)
+            results[position + start:position + start + count] = statistics
+        position += size
+
+    return results
+
+
+def endpoint_standard_errors(statistics, percentiles):
+    """Returns the Monte Carlo standard error of each of the given
+    percentiles of an array of bootstrapped statistics"""
+    # The number of statistics below a percentile is binomial, so the
+    # order statistics one binomial SD either side of its rank bracket
+    # the percentile by about two standard errors
+    return _ordered_endpoint_errors(np.sort(statistics), percentiles)
+
+
+def _ordered_endpoint_errors(ordered, percentiles):
+    """Returns endpoint_standard_errors of statistics already sorted"""
+    replications = len(ordered)
+    q = np.asarray(percentiles) / 100
+    spread = np.sqrt(replications * q * (1 - q))
+    lower = np.clip(np.floor(replications * q - spread).astype(int), 0, replications - 1)
+    upper = np.clip(np.ceil(replications * q + spread).astype(int), 0, replications - 1)
+    return (ordered[upper] - ordered[lower]) / 2
+
+
+def _map_blocks(executor, groups, values, statistic, sample_size, memory_budget,
+                seeds, sizes, resampling):
+    """Returns the bootstrapped statistics of each group of blocks, computed
+    in this process if executor is None and by the executor otherwise"""
+    seed_groups = [[seeds[i] for i in group] for group in groups]
+    size_groups = [[sizes[i] for i in group] for group in groups]
+    if executor is None:
+        return [
+            _bootstrap_blocks(values, statistic, sample_size, memory_budget,
+                              group_seeds, group_sizes, resampling)
+            for group_seeds, group_sizes in zip(seed_groups, size_groups)
+        ]
+    return list(executor.map(
+        _bootstrap_blocks,
+        [values] * len(groups),
+        [statistic] * len(groups),
+        [sample_size] * len(groups),
+        [memory_budget] * len(groups),
+        seed_groups,
+        size_groups,
+        [resampling] * len(groups),
+    ))
+
+
+def _value_key(value):
+    """Returns a string identifying a value that a statistic depends on, or
+    None if the value cannot be identified reliably"""
+    if isinstance(value, ModuleType):
+        return f"module {value.__name__}"
+    if callable(value):
+        return _function_key(value, dependencies=False)
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            return None
+        digest = hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()
+        return f"array({value.dtype}, {value.shape}, {digest})"
+    text = repr(value)
+    if ' at 0x' in text or '...' in text:
+        return None
+    return text
+
+
+def _global_names(code):
+    """Returns the names of the global variables that code (or code nested
+    in it) may use"""
+    names = set(code.co_names)
+    for constant in code.co_consts:
+        if isinstance(constant, CodeType):
+            names |= _global_names(constant)
+    return names
+
+
+def _function_key(function, dependencies=True):
+    """Returns a string identifying a function, or None if the function
+    cannot be identified reliably (a lambda or a local function, or a value
+    it depends on that has no reliable identity):
+    function: the function
+    dependencies: if True, the key includes the function's default
+        arguments, the values of the variables it closes over, and the
+        values of the global variables it uses; functions among those
+        values are identified by their code only
+    """
+    if isinstance(function, partial):
+        inner = _function_key(function.func, dependencies)
+        arguments = [_value_key(value) for value in function.args]
+        arguments += [_value_key(value) for _, value in sorted(function.keywords.items())]
+        if inner is None or None in arguments:
+            return None
+        return f"partial({inner}, {sorted(function.keywords)}, {arguments})"
+
+    name = f"{getattr(function, '__module__', '')}.{getattr(function, '__qualname__', '')}"
+    if '<' in name or name == '.':
+        return None
+    code = getattr(function, '__code__', None)
+    if code is None:
+        return name
+    key = f"{name}:{hashlib.sha256(code.co_code + repr(code.co_consts).encode()).hexdigest()}"
+    if not dependencies:
+        return key
+
+    values = list(function.__defaults__ or ())
+    values += [value for _, value in sorted((function.__kwdefaults__ or {}).items())]
+    values += [cell.cell_contents for cell in function.__closure__ or ()]
+    global_names = sorted(_global_names(code) & set(function.__globals__))
+    values += [function.__globals__[global_name] for global_name in global_names]
+    value_keys = [_value_key(value) for value in values]
+    if None in value_keys:
+        return None
+    digest = hashlib.sha256(repr((global_names, value_keys)).encode()).hexdigest()
+    return f"{key}:{digest}"
+
+
+def _cache_key(values, statistic, replications, sample_size, seed, resampling,
+               tolerance, level):
+    """Returns the name under which bootstrap results are cached, or None if
+    they cannot be cached"""
+    statistic_key = _function_key(statistic)
+    if statistic_key is None or values.dtype == object:
+        return None
+
+    digest = hashlib.sha256()
+    with open(__file__, 'rb') as source:
+        digest.update(source.read())
+    digest.update(str(values.dtype).encode())
+    digest.update(np.ascontiguousarray(values).tobytes())
+    settings = (statistic_key, replications, sample_size, seed, resampling, tolerance, level)
+    digest.update(repr(settings).encode())
+    return digest.hexdigest()
+
+
+def _load_cached(key):
+    """Returns the cached results stored under key, or None"""
+    path = os.path.join(CACHE_DIRECTORY, key + '.npz')
+    try:
+        with np.load(path) as cached:
+            results = cached['statistics']
+    except (OSError, KeyError, ValueError):
+        return None
+
+    # The modification time records when an entry was last used
+    os.utime(path)
+    return results
+
+
+def _store_cached(key, results):
+    """Stores results under key, then removes the least recently used
+    entries until the cache fits in CACHE_SIZE_LIMIT"""
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    path = os.path.join(CACHE_DIRECTORY, key + '.npz')
+    partial_path = os.path.join(CACHE_DIRECTORY, f"{key}.{os.getpid()}.partial.npz")
+    np.savez_compressed(partial_path, statistics=results)
+    os.replace(partial_path, path)
+
+    entries = []
+    for entry in glob.glob(os.path.join(CACHE_DIRECTORY, '*.npz')):
+        try:
+            status = os.stat(entry)
+        except OSError:
+            continue
+        entries.append((status.st_mtime, status.st_size, entry))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in entries:
+        if total <= CACHE_SIZE_LIMIT or entry == path:
+            break
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+        total -= size
+
+
+def bootstrap_statistic(values, statistic, replications, sample_size=None,
+                        memory_budget=DEFAULT_MEMORY_BUDGET, seed=None, workers=1,
+                        resampling='rows', tolerance=None, level=95, cache=False):
+    """Returns an array of bootstrapped values of a statistic:
+    values: array (or column) containing the original sample
+    statistic: function that takes a 2-D array of samples, one sample
+        per row, and returns the statistic of each row
+    replications: number of bootstrap samples, or the largest number to
+        draw if tolerance is given
+    sample_size: size of each bootstrap sample, defaults to len(values)
+    memory_budget: number of bytes the resampling buffers of each process
+        may use; the samples are drawn in chunks that fit in it, so memory
+        use does not grow with the number of replications
+    seed: seed for the random draws; the same seed always gives the same
+        array, whatever the number of workers
+    workers: number of processes to split the replications across, or
+        None for one per CPU; with more than one worker, statistic must be
+        a module-level function so that it can be sent to the processes
+    resampling: 'rows' to draw the samples themselves; 'ranks' to draw
+        the same samples but reduce each to counts of the distinct values,
+        which gives the same results and pays off when there are few
+        distinct values compared with sample_size; 'multinomial' to draw
+        only how many times each value is in a sample, or 'poisson' to
+        draw those counts independently (so sample sizes vary around
+        sample_size, and an empty sample gives nan); every method but
+        'rows' needs a statistic with an entry in WEIGHTED_STATISTICS
+    tolerance: if given, replications are drawn BLOCK_SIZE at a time and
+        drawing stops as soon as the Monte Carlo standard errors of both
+        ends of the level% percentile interval are at most tolerance; the
+        length of the returned array is the number of replications used
+    level: confidence level of the interval watched when tolerance is given
+    cache: if True and seed is given, the results are kept in
+        CACHE_DIRECTORY, keyed by the values, the statistic and the other
+        settings that affect them, and later calls with the same key load
+        them instead of drawing again; the key covers the statistic's code,
+        default arguments, closure and global variables, but not the
+        values the functions it calls depend on, so only turn it on for
+        statistics whose results depend on nothing else
+    """
+    values = np.asarray(values)
+    if sample_size is None:
+        sample_size = len(values)
+    if workers is None:
+        workers = os.cpu_count()
+    if resampling != 'rows':
+        if statistic not in WEIGHTED_STATISTICS:
+            raise ValueError(f"{resampling} resampling needs a statistic in WEIGHTED_STATISTICS")
+        statistic = WEIGHTED_STATISTICS[statistic]
+
+    key = None
+    if cache and seed is not None:
+        key = _cache_key(values, statistic, replications, sample_size, seed, resampling,
+                         tolerance, level)
+    if key is not None:
+        cached = _load_cached(key)
+        if cached is not None:
+            return cached
+
+    results = _draw_statistics(values, statistic, replications, sample_size, memory_budget,
+                               seed, workers, resampling, tolerance, level)
+    if key is not None:
+        _store_cached(key, results)
+    return results
+
+
+def _draw_statistics(values, statistic, replications, sample_size, memory_budget, seed,
+                     workers, resampling, tolerance, level):
+    """Returns the array of bootstrapped statistics described by the
+    arguments of bootstrap_statistic"""
+    # Every block of replications gets its own independent stream, so the
+    # draws do not depend on how the blocks are shared among the workers
+    sizes = [BLOCK_SIZE] * (replications // BLOCK_SIZE)
+    if replications % BLOCK_SIZE:
+        sizes.append(replications % BLOCK_SIZE)
+    if not sizes:
+        return np.empty(0)
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    blocks = np.arange(len(sizes))
+    arguments = (values, statistic, sample_size, memory_budget, seeds, sizes, resampling)
+
+    workers = min(workers, len(sizes))
+    with ProcessPoolExecutor(workers) if workers > 1 else nullcontext() as executor:
+        if tolerance is None:
+            groups = np.array_split(blocks, workers)
+            return np.concatenate(_map_blocks(executor, groups, *arguments))
+
+        # Each round draws one block per worker, but convergence is checked
+        # block by block so that where drawing stops does not depend on
+        # the number of workers
+        tail = (100 - level) / 2
+        statistics = np.empty(replications)
+        # The statistics so far in increasing order, kept by merging in each
+        # sorted block rather than sorting everything again; the merge
+        # writes into the other buffer and the two take turns
+        ordered = np.empty(replications)
+        merged = np.empty(replications)
+        filled = 0
+        for start in np.arange(0, len(sizes), workers):
+            groups = [[block] for block in blocks[start:start + workers]]
+            for part in _map_blocks(executor, groups, *arguments):
+                statistics[filled:filled + len(part)] = part
+                part = np.sort(part)
+                positions = np.searchsorted(ordered[:filled], part) + np.arange(len(part))
+                kept = np.ones(filled + len(part), dtype=bool)
+                kept[positions] = False
+                merged[positions] = part
+                merged[:filled + len(part)][kept] = ordered[:filled]
+                ordered, merged = merged, ordered
+                filled += len(part)
+                errors = _ordered_endpoint_errors(ordered[:filled], [tail, 100 - tail])
+                if np.all(errors <= tolerance):
+                    return statistics[:filled]
+        return statistics
+
+
+def jackknife_means(values):
+    """Returns the mean of values with each value left out in turn"""
+    values = np.asarray(values, dtype=float)
+    return (values.sum() - values) / (len(values) - 1)
+
+
+def jackknife_proportions(values):
+    """Returns the proportion of nonzero (True) values with each value left
+    out in turn"""
+    nonzero = np.asarray(values) != 0
+    return (np.count_nonzero(nonzero) - nonzero) / (len(nonzero) - 1)
+
+
+def jackknife_percentiles(values, p):
+    """Returns the pth percentile, as computed by np.percentile, of values
+    with each value left out in turn"""
+    values = np.asarray(values)
+    n = len(values)
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+
+    # With the value of rank r left out, the kth smallest remaining value
+    # is sorted_values[k] if k < r and sorted_values[k + 1] otherwise
+    ranks = np.empty(n, dtype=np.intp)
+    ranks[order] = np.arange(n)
+    position = (n - 2) * p / 100
+    below = int(np.floor(position))
+    above = min(below + 1, n - 2)
+    lower = sorted_values[below + (ranks <= below)]
+    upper = sorted_values[above + (ranks <= above)]
+    return lower + (position - below) * (upper - lower)
+
+
+def jackknife_medians(values):
+    """Returns the median of values with each value left out in turn"""
+    return jackknife_percentiles(values, 50)
+
+
+# Statistics of resampled rows and the matching leave-one-out formulas
+JACKKNIFE_STATISTICS = {
+    medians: jackknife_medians,
+    means: jackknife_means,
+    proportions: jackknife_proportions,
+}
+
+
+def jackknife_statistics(values, statistic, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Returns the statistic of values with each value left out in turn,
+    from a formula in JACKKNIFE_STATISTICS if there is one and otherwise
+    by applying statistic to the leave-one-out samples, as many at once as
+    fit in memory_budget bytes"""
+    if statistic in JACKKNIFE_STATISTICS:
+        return JACKKNIFE_STATISTICS[statistic](values)
+    values = np.asarray(values)
+    n = len(values)
+    chunk_size = chunk_size_for(memory_budget, n - 1, values.itemsize)
+    columns = np.arange(n - 1)
+    results = []
+    for start in np.arange(0, n, chunk_size):
+        left_out = np.arange(start, min(start + chunk_size, n))
+        # Row i takes every position but i
+        positions = columns + (columns >= left_out[:, np.newaxis])
+        results.append(statistic(values[positions]))
+    return np.concatenate(results)
+
+
+def mean_standard_errors(samples):
+    """Returns the estimated standard error of the mean of each row"""
+    return np.std(samples, axis=1, ddof=1) / np.sqrt(samples.shape[1])
+
+
+def proportion_standard_errors(samples):
+    """Returns the estimated standard error of the proportion of nonzero
+    (True) entries in each row"""
+    p = proportions(samples)
+    return np.sqrt(p * (1 - p) / samples.shape[1])
+
+
+def median_standard_errors(samples):
+    """Returns the McKean-Schrader estimate of the standard error of the
+    median of each row"""
+    n = samples.shape[1]
+    z = NormalDist().inv_cdf(0.975)
+    c = int(np.clip(np.round((n + 1) / 2 - z * np.sqrt(n / 4)), 1, n))
+    ordered = np.sort(samples, axis=1)
+    return (ordered[:, n - c] - ordered[:, c - 1]) / (2 * z)
+
+
+# Statistics of resampled rows and estimates of their standard errors
+STANDARD_ERRORS = {
+    medians: median_standard_errors,
+    means: mean_standard_errors,
+    proportions: proportion_standard_errors,
+}
+
+
+def _t_statistics(samples, statistic, standard_errors, estimate):
+    """Returns the studentized statistic of each row of samples"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (statistic(samples) - estimate) / standard_errors(samples)
+
+
+def confidence_interval(values, statistic, replications, level=95,
+                        method='percentile', **options):
+    """Returns an array with the two ends of a bootstrap confidence interval:
+    values: array (or column) containing the original sample
+    statistic: function that takes a 2-D array of samples, one sample
+        per row, and returns the statistic of each row
+    replications: number of bootstrap samples
+    level: confidence level of the interval, in percent
+    method: 'percentile' for the middle level% of the bootstrapped
+        statistics; 'bca' to shift and stretch those percentiles by the
+        bias-corrected and accelerated method; 'studentized' for the
+        bootstrap-t interval, which needs a statistic with an entry in
+        STANDARD_ERRORS
+    options: passed on to bootstrap_statistic; with 'bca', memory_budget
+        also limits the leave-one-out samples
+    """
+    values = np.asarray(values)
+    tail = (100 - level) / 2
+    estimate = statistic(values[np.newaxis, :])[0]
+
+    if method == 'percentile':
+        statistics = bootstrap_statistic(values, statistic, replications, **options)
+        return np.percentile(statistics, [tail, 100 - tail])
+
+    if method == 'bca':
+        statistics = bootstrap_statistic(values, statistic, replications, **options)
+        normal = NormalDist()
+
+        # Bias correction: how far the bootstrapped statistics are centered
+        # away from the estimate
+        below = np.count_nonzero(statistics < estimate)
+        ties = np.count_nonzero(statistics == estimate)
+        bias = normal.inv_cdf(np.clip((below + ties / 2) / len(statistics), 1e-10, 1 - 1e-10))
+
+        # Acceleration: skewness of the leave-one-out statistics
+        jackknife = jackknife_statistics(values, statistic,
+                                         options.get('memory_budget', DEFAULT_MEMORY_BUDGET))
+        deviations = np.mean(jackknife) - jackknife
+        spread = np.sum(deviations ** 2)
+        acceleration = np.sum(deviations ** 3) / (6 * spread ** 1.5) if spread > 0 else 0
+
+        ends = []
+        for q in [tail, 100 - tail]:
+            z = bias + normal.inv_cdf(q / 100)
+            ends.append(100 * normal.cdf(bias + z / (1 - acceleration * z)))
+        return np.percentile(statistics, ends)
+
+    if method == 'studentized':
+        if statistic not in STANDARD_ERRORS:
+            raise ValueError("studentized intervals need a statistic in STANDARD_ERRORS")
+        standard_errors = STANDARD_ERRORS[statistic]
+        t_statistics = partial(_t_statistics, statistic=statistic,
+                               standard_errors=standard_errors, estimate=estimate)
+        t = bootstrap_statistic(values, t_statistics, replications, **options)
+        standard_error = standard_errors(values[np.newaxis, :])[0]
+        t_low, t_high = np.nanpercentile(t, [tail, 100 - tail])
+        return np.array([estimate - t_high * standard_error, estimate - t_low * standard_error])
+
+    raise ValueError(f"unknown interval method: {method!r}")
+
+
+def _along_rows(samples, statistic):
+    """Returns statistic applied to every row of samples in one call, or
+    one row at a time if the call does not give one value per row"""
+    results = np.asarray(statistic(samples, axis=1))
+    if results.shape != (len(samples),):
+        return _each_row(samples, statistic)
+    return results
+
+
+def _each_row(samples, statistic):
+    """Returns statistic applied to the rows of samples one at a time"""
+    return np.array([statistic(row) for row in samples])
+
+
+def accepts_axis(statistic):
+    """Returns True if statistic has an axis argument"""
+    try:
+        parameters = signature(statistic).parameters
+    except (TypeError, ValueError):
+        return False
+    return 'axis' in parameters and parameters['axis'].kind not in (
+        Parameter.VAR_POSITIONAL, Parameter.VAR_KEYWORD
+    )
+
+
+# Functions of one sample that have a row-wise version in this module
+ROW_STATISTICS = {
+    np.median: medians,
+    np.mean: means,
+}
+
+
+def row_statistic(statistic):
+    """Returns a function that computes statistic, a function of one sample,
+    for each row of a 2-D array of samples"""
+    if statistic in ROW_STATISTICS:
+        return ROW_STATISTICS[statistic]
+    if accepts_axis(statistic):
+        return partial(_along_rows, statistic=statistic)
+    return partial(_each_row, statistic=statistic)
+
+
+def bootstrap(table, label, statistic, replications, **options):
+    """Returns an array of bootstrapped values of a statistic:
+    table: table containing the original sample
+    label: label of column containing the variable
+    statistic: function that takes an array of values and returns a number;
+        if it accepts an axis argument, like np.median or np.mean, it is
+        applied to all the bootstrap samples of a chunk at once, and
+        otherwise to one bootstrap sample at a time
+    replications: number of bootstrap samples
+    options: passed on to bootstrap_statistic
+    """
+    return bootstrap_statistic(table[label], row_statistic(statistic), replications, **options)
+
+
+def coverage_experiment(population, statistic, parameter, samples, replications,
+                        sample_size, level=95, seed=None,
+                        memory_budget=DEFAULT_MEMORY_BUDGET):
+    """Returns a (samples x 2) array of bootstrap percentile intervals and
+    the proportion of them that contain the parameter:
+    population: array (or column) containing the population
+    statistic: function that takes a 2-D array of samples, one sample
+        per row, and returns the statistic of each row
+    parameter: value of the statistic in the population
+    samples: number of original samples drawn from the population
+    replications: number of bootstrap samples of each original sample
+    sample_size: size of each original sample and its bootstrap samples
+    level: confidence level of the intervals, in percent
+    seed: seed for the random draws
+    memory_budget: number of bytes the bootstrap samples of a chunk of
+        original samples may use
+    """
+    population = np.asarray(population)
+    tail = (100 - level) / 2
+
+    # All the original samples of a chunk, and all their bootstrap samples,
+    # are drawn and reduced together; drawing an original sample takes one
+    # random key per member of the population
+    chunk_size = chunk_size_for(memory_budget, replications * sample_size + len(population),
+                                population.itemsize)
+    chunk_size = max(1, min(samples, chunk_size))
+
+    # Separate streams for the original samples and the bootstrap samples
+    # keep the results independent of the chunk size
+    sample_rng, bootstrap_rng = [
+        np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(2)
+    ]
+
+    intervals = np.empty((samples, 2))
+    for start in np.arange(0, samples, chunk_size):
+        stop = min(start + chunk_size, samples)
+        count = stop - start
+        # The members with the sample_size smallest random keys are a
+        # random sample drawn without replacement
+        keys = sample_rng.random((count, len(population)))
+        originals = population[np.argpartition(keys, sample_size - 1, axis=1)[:, :sample_size]]
+        uniforms = bootstrap_rng.random((count, replications, sample_size))
+        rows = (uniforms * sample_size).astype(np.intp)
+        rows += (np.arange(count) * sample_size)[:, np.newaxis, np.newaxis]
+        resamples = originals.ravel()[rows].reshape(count * replications, sample_size)
+        statistics = statistic(resamples).reshape(count, replications)
+        intervals[start:stop] = np.percentile(statistics, [tail, 100 - tail], axis=1).T
+
+    covered = (intervals[:, 0] <= parameter) & (parameter <= intervals[:, 1])
+    return intervals, np.count_nonzero(covered) / samples
+
+
+def plot_intervals(intervals, parameter, color='gold'):
+    """Draws each interval of a (samples x 2) array at its own height, with
+    a red line at the parameter, using a single collection of lines"""
+    heights = np.arange(1, len(intervals) + 1)
+    segments = np.stack([
+        np.column_stack([intervals[:, 0], heights]),
+        np.column_stack([intervals[:, 1], heights]),
+    ], axis=1)
+
+    axes = plots.gca()
+    axes.add_collection(LineCollection(segments, colors=color))
+    axes.autoscale()
+    plots.plot(np.array([parameter, parameter]), np.array([0, len(intervals)]), color='red', lw=2)